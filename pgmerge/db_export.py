@@ -4,9 +4,18 @@ pgmerge - a PostgreSQL data import and merge utility
 Copyright 2018-2020 Simon Muller (samullers@gmail.com)
 """
 import os
+import gzip
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .db_meta import SchemaCache
 
 DEFAULT_FILE_FORMAT = "FORMAT CSV, HEADER, ENCODING 'UTF8'"
+# PostgreSQL's binary COPY format: smaller and skips the text formatter for wide/numeric tables,
+# but less portable than CSV between database versions and architectures
+BINARY_FILE_FORMAT = "FORMAT BINARY"
+# Each worker thread exports one table at a time using its own pooled connection
+MAX_EXPORT_WORKERS = 8
 _log = logging.getLogger(__name__)
 
 
@@ -74,28 +83,37 @@ def replace_local_columns_with_alternate_keys(inspector, config_per_table, schem
     return foreign_columns
 
 
-def export_tables_per_config(connection, inspector, schema, output_dir, tables,
-                             config_per_table=None, file_format=None):
+def export_tables_per_config(engine, inspector, schema, output_dir, tables,
+                             config_per_table=None, file_format=None, compress=False,
+                             binary=False, max_workers=MAX_EXPORT_WORKERS):
     """
     Exports all given tables according to the options specified in the config_per_table dictionary.
-    """
-    if connection.encoding != 'UTF8':
-        # raise ExportException('Database connection encoding isn\'t UTF8: {}'.format(connection.encoding))
-        print('WARNING: Setting database connection encoding to UTF8 instead of {}'.format(connection.encoding))
-        connection.set_client_encoding('UTF8')
 
+    Since each table's COPY statement is independent, tables are exported in parallel by a pool of
+    worker threads that each acquire their own connection from the engine's pool. This overlaps
+    network I/O with server-side scans of independent tables.
+
+    If compress is set, output is streamed through gzip, trading some cheap CPU cycles for far
+    fewer bytes written to disk. If binary is set, PostgreSQL's binary COPY format is used and
+    ".bin" files are written instead of ".csv".
+    """
     if file_format is None:
-        file_format = DEFAULT_FILE_FORMAT
+        file_format = BINARY_FILE_FORMAT if binary else DEFAULT_FILE_FORMAT
     if config_per_table is None:
         config_per_table = {}
+    file_extension = ('.bin' if binary else '.csv') + ('.gz' if compress else '')
 
-    cursor = connection.cursor()
-    file_count = 0
+    # Memoize introspection since tables and their foreign keys are inspected repeatedly while
+    # generating export queries (shared between workers as it's only altered under the GIL)
+    inspector = SchemaCache(inspector)
+
+    # Determine the files to be generated in the main thread since this alters shared config
+    # state: one file per table plus one for each of its subsets
+    file_configs_per_table = {}
     for table in tables:
         if table not in config_per_table or config_per_table[table] is None:
             config_per_table[table] = {}
 
-        # Determine files to be generated: one per table plus one for each of its subsets
         file_configs = [config_per_table[table]]
         file_configs[0]['name'] = table
 
@@ -108,29 +126,66 @@ def export_tables_per_config(connection, inspector, schema, output_dir, tables,
                     if file_config.get('columns') is None:
                         file_config['columns'] = column_config
 
-        for file_config in file_configs:
-            if 'columns' in file_config:
-                local_columns = file_config['columns']
-            else:
-                local_columns = [col['name'] for col in inspector.get_columns(table, schema)]
-            foreign_columns = replace_local_columns_with_alternate_keys(inspector, config_per_table, schema,
-                                                                        table, local_columns)
-            where_clause = file_config.get('where')
-            order_columns = get_unique_columns(inspector, table, schema)
-            # Remove columns that are not selected to be part of export
-            order_columns_to_remove = list(set(order_columns).difference(set(local_columns)))
-            if len(order_columns_to_remove) > 0:
-                order_columns = [col for col in order_columns if col not in order_columns_to_remove]
-            output_file = os.path.join(output_dir, file_config['name'] + '.csv')
-            export_table_with_any_columns(cursor, inspector, output_file, schema, table,
-                                          any_columns=foreign_columns, order_columns=order_columns,
-                                          file_format=file_format, where_clause=where_clause)
-        file_count += len(file_configs)
-
-    connection.commit()
+        file_configs_per_table[table] = file_configs
+
+    file_count = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(export_table_files, engine, inspector, schema, output_dir,
+                                   table, file_configs_per_table[table], config_per_table, file_format,
+                                   file_extension)
+                   for table in tables]
+        for future in futures:
+            file_count += future.result()
     return len(tables), file_count
 
 
+def export_table_files(engine, inspector, schema, output_dir, table, file_configs,
+                       config_per_table, file_format, file_extension='.csv'):
+    """
+    Exports the files for a single table on its own connection acquired from the engine's pool.
+    """
+    connection = engine.raw_connection()
+    try:
+        # End the implicit transaction opened by the pool's pre-ping "SELECT 1", since
+        # set_client_encoding and set_session refuse to run inside a transaction
+        connection.rollback()
+        if connection.encoding != 'UTF8':
+            # raise ExportException('Database connection encoding isn\'t UTF8: {}'.format(connection.encoding))
+            print('WARNING: Setting database connection encoding to UTF8 instead of {}'.format(connection.encoding))
+            connection.set_client_encoding('UTF8')
+
+        cursor = connection.cursor()
+        # Run all of this table's COPY statements within a single read-only transaction so that
+        # they share one read snapshot and no per-statement transaction overhead is paid
+        connection.set_session(readonly=True)
+        try:
+            for file_config in file_configs:
+                if 'columns' in file_config:
+                    local_columns = file_config['columns']
+                else:
+                    local_columns = [col['name'] for col in inspector.get_columns(table, schema)]
+                foreign_columns = replace_local_columns_with_alternate_keys(inspector, config_per_table, schema,
+                                                                            table, local_columns)
+                where_clause = file_config.get('where')
+                order_columns = get_unique_columns(inspector, table, schema)
+                # Remove columns that are not selected to be part of export
+                order_columns_to_remove = list(set(order_columns).difference(set(local_columns)))
+                if len(order_columns_to_remove) > 0:
+                    order_columns = [col for col in order_columns if col not in order_columns_to_remove]
+                output_file = os.path.join(output_dir, file_config['name'] + file_extension)
+                export_table_with_any_columns(cursor, inspector, output_file, schema, table,
+                                              any_columns=foreign_columns, order_columns=order_columns,
+                                              file_format=file_format, where_clause=where_clause)
+            connection.commit()
+        finally:
+            # Reset the session so the connection isn't returned to the pool in read-only mode
+            connection.rollback()
+            connection.set_session(readonly=False)
+    finally:
+        connection.close()
+    return len(file_configs)
+
+
 def sql_join_from_foreign_key(foreign_key, table_or_alias, join_alias=None,
                               local_columns_key='constrained_columns', foreign_columns_key='referred_columns'):
     assert local_columns_key in foreign_key
@@ -224,7 +279,13 @@ def export_table_with_any_columns(cursor, inspector, output_path, schema, main_t
         .format(select_sql=select_sql, file_format=file_format)
     log_sql(copy_sql)
 
-    with open(output_path, 'wb') as output_file:
+    if output_path.endswith('.gz'):
+        # Stream the COPY output through gzip so fewer bytes ever reach the disk. A low
+        # compression level is used since the write is I/O-bound, not CPU-bound.
+        output_file = gzip.open(output_path, 'wb', compresslevel=1)
+    else:
+        output_file = open(output_path, 'wb')
+    with output_file:
         cursor.copy_expert(copy_sql, output_file)
 
 
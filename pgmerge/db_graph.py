@@ -5,18 +5,32 @@ pgmerge - a PostgreSQL data import and merge utility
 Copyright 2018-2020 Simon Muller (samullers@gmail.com)
 """
 import logging
+from collections import deque
+
 import networkx as nx
 
+from . import db_meta
+
 _log = logging.getLogger(__name__)
 
 
 def get_cycles(graph):
-    return list(nx.simple_cycles(graph))
+    """
+    Find all simple cycles in the graph. Since cycle enumeration is expensive (exponential in the
+    worst case), the result is memoized on the graph object itself. The cache is keyed on the
+    graph's size so that it recomputes lazily after edges are removed (e.g. by break_cycles).
+    """
+    cache = graph.graph.setdefault('_cycles_per_size', {})
+    size = (graph.number_of_nodes(), graph.number_of_edges())
+    if size not in cache:
+        cache[size] = list(nx.simple_cycles(graph))
+    return cache[size]
 
 
 def break_cycles(graph):
     edges_removed = []
-    simple_cycles = list(nx.simple_cycles(graph))
+    # Copy the cycles since we sort them in-place and the result might be cached
+    simple_cycles = [list(cycle) for cycle in get_cycles(graph)]
     # Ensure the cycles are sorted
     for cycle in simple_cycles:
         cycle.sort()
@@ -37,28 +51,84 @@ def convert_to_dag(directed_graph):
 
 
 def get_dependents(directed_acyclic_graph, node):
-    assert nx.is_directed_acyclic_graph(directed_acyclic_graph), "Graph contains cycles."
+    # Sanity check costs a full O(V+E) traversal, so only run it in debug mode ("python -O"
+    # strips it out)
+    if __debug__:
+        assert nx.is_directed_acyclic_graph(directed_acyclic_graph), "Graph contains cycles."
     return list(nx.descendants(directed_acyclic_graph, node))
 
 
 def get_fks_for_direct_cycles(table_graph, direct_cycles):
-    fks = [table_graph.get_edge_data(cycle[0], cycle[1])['name'] for cycle in direct_cycles if len(cycle) == 2]
-    fks.extend([table_graph.get_edge_data(cycle[1], cycle[0])['name'] for cycle in direct_cycles if len(cycle) == 2])
+    # Collect both directions of each two-table cycle in a single pass (indexing the edge dicts
+    # directly since both edges are known to exist)
+    fks = []
+    for cycle in direct_cycles:
+        if len(cycle) == 2:
+            table_a, table_b = cycle
+            fks.append(table_graph[table_a][table_b]['name'])
+            fks.append(table_graph[table_b][table_a]['name'])
     return fks
 
 
 def get_insertion_order(table_graph):
-    copy_of_graph = table_graph.copy()
-    convert_to_dag(copy_of_graph)
-    return list(reversed(list(nx.topological_sort(copy_of_graph))))
+    """
+    Determine an order in which tables can be inserted so that every table comes after the tables
+    it depends on. Implemented as Kahn's algorithm over counts of unresolved dependencies, which
+    avoids copying the whole graph just to break its cycles: whenever only cyclic dependencies
+    remain, the table with the fewest unresolved dependencies is force-resolved, which is
+    equivalent to breaking one edge of each remaining cycle.
+    """
+    # Count how many tables each table still depends on (ignoring self-references)
+    unresolved = {table: sum(1 for dependency in table_graph.successors(table) if dependency != table)
+                  for table in table_graph}
+    ready = deque(sorted(table for table, count in unresolved.items() if count == 0))
+    for table in ready:
+        del unresolved[table]
+
+    order = []
+    while len(ready) > 0 or len(unresolved) > 0:
+        if len(ready) == 0:
+            # Only cycles remain, so break one by force-resolving a table
+            table = min(sorted(unresolved), key=lambda tbl: unresolved[tbl])
+            del unresolved[table]
+            ready.append(table)
+        table = ready.popleft()
+        order.append(table)
+        for dependent in table_graph.predecessors(table):
+            if dependent in unresolved:
+                unresolved[dependent] -= 1
+                if unresolved[dependent] <= 0:
+                    del unresolved[dependent]
+                    ready.append(dependent)
+    return order
+
+
+def get_fks_per_table(inspector, schema, tables):
+    """
+    Fetch the foreign keys for all the given tables. On PostgreSQL a single query is used to fetch
+    the foreign keys of the whole schema at once, instead of issuing one query per table. Other
+    engines fall back to querying per table.
+    """
+    if inspector.bind.dialect.name == 'postgresql':
+        connection = inspector.bind.raw_connection()
+        try:
+            all_fks = db_meta.get_all_foreign_keys(connection.cursor(), schema)
+        finally:
+            connection.close()
+        return {table: all_fks.get(table, []) for table in tables}
+    return {table: inspector.get_foreign_keys(table, schema) for table in tables}
 
 
-def build_fk_dependency_graph(inspector, schema, tables=None):
+def build_fk_dependency_graph(inspector, schema, tables=None, fks_per_table=None):
     table_graph = nx.OrderedDiGraph()
     if tables is None:
         tables = sorted(inspector.get_table_names(schema))
+    if fks_per_table is None:
+        fks_per_table = get_fks_per_table(inspector, schema, tables)
+    else:
+        fks_per_table = {table: fks_per_table.get(table, []) for table in tables}
     for table in tables:
-        fks = inspector.get_foreign_keys(table, schema)
+        fks = fks_per_table[table]
         table_graph.add_node(table)
         for fky in fks:
             assert fky['referred_schema'] == schema, 'Remote tables not supported'
@@ -87,21 +157,29 @@ def get_all_dependent_tables(table_graph, tables):
     a table and that table has a dependency on 2 other tables, then we'll get all 3 tables. We return all referenced
     tables as well as the given set of tables.
     """
-    dependent_tables = set()
-    trees = []
-    for table in sorted(tables):
-        dependency_tree = nx.dfs_successors(table_graph, table)
-        dependent_tables.add(table)  # Not in tree if it doesn't have any dependents
-        dependent_tables.update(set(dependency_tree.keys()))
-        dependent_tables.update({node for dependents in dependency_tree.values() for node in dependents})
-        trees.append((table, dependency_tree))
+    tables = sorted(tables)
+    # A single breadth-first search starting from all the given tables at once, instead of a
+    # separate traversal per table that redoes work for any shared dependencies
+    dependent_tables = set(tables)
+    frontier = list(tables)
+    while len(frontier) > 0:
+        next_frontier = []
+        for table in frontier:
+            for successor in table_graph.successors(table):
+                if successor not in dependent_tables:
+                    dependent_tables.add(successor)
+                    next_frontier.append(successor)
+        frontier = next_frontier
 
     if len(dependent_tables) > len(set(tables)):
         print('Also including the following dependent tables:\n')
-        for table, dependency_tree in trees:
-            for node in sorted(dependency_tree.keys(), key=lambda x: '' if x == table else x):
-                indent = '\t' if node == table else '\t  '
-                print(indent + '{} -> {}'.format(node, ', '.join(sorted(dependency_tree[node]))))
+        # List the given tables first, each with its direct dependencies
+        for node in sorted(dependent_tables, key=lambda x: (x not in tables, x)):
+            successors = sorted(set(table_graph.successors(node)))
+            if len(successors) == 0:
+                continue
+            indent = '\t' if node in tables else '\t  '
+            print(indent + '{} -> {}'.format(node, ', '.join(successors)))
         print('')
         print('Final tables exported: ' + ' '.join(sorted(list(dependent_tables))))
         print('')
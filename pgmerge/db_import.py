@@ -3,15 +3,35 @@ pgmerge - a PostgreSQL data import and merge utility
 
 Copyright 2018-2020 Simon Muller (samullers@gmail.com)
 """
+import gzip
 import logging
+import functools
 
-from .db_export import get_unique_columns, replace_indexes, \
+from psycopg2 import sql as pg_sql
+
+from .db_export import DEFAULT_FILE_FORMAT, BINARY_FILE_FORMAT, \
+    get_unique_columns, replace_indexes, \
     replace_local_columns_with_alternate_keys, \
     sql_select_table_with_foreign_columns, \
     sql_join_alias_for_foreign_key, sql_join_from_foreign_key
 
 _log = logging.getLogger(__name__)
 
+# Statement templates are defined once at module level instead of being rebuilt per call
+_SQL_ROW_HASH = "md5(ROW({row_sql})::text)"
+_SQL_DELETE_IDENTICAL_ROWS = "DELETE FROM {dlt} USING {ref} WHERE {dlt_hash} = {ref_hash};"
+_SQL_SELECT_MISSING_ROWS = \
+    "SELECT {sel_cols} FROM {ref} LEFT JOIN {ins} ON ({ins_cols}) = ({ref_cols}) WHERE ({ins_cols}) is NULL"
+_SQL_INSERT_MISSING_ROWS = "INSERT INTO {ins}({cols}) ({select_sql}) RETURNING NULL;"
+_SQL_UPDATE_MATCHING_ROWS = "UPDATE {upd} SET {set_columns} FROM {ref} WHERE {where_clause};"
+# Templates composed with psycopg2.sql so that interpolated identifiers are safely quoted
+_SQL_CREATE_TMP_COPY = pg_sql.SQL("CREATE TEMP TABLE {tmp_copy} AS {select_sql} LIMIT 0;")
+_SQL_COPY_FROM = pg_sql.SQL('COPY {tbl} FROM STDOUT WITH ({file_format});')
+_SQL_ANALYZE = pg_sql.SQL("ANALYZE {tbl};")
+_SQL_CREATE_TMP_FINAL = pg_sql.SQL("CREATE TEMP TABLE {tmp_final} AS {select_sql};")
+_SQL_CREATE_INDEX = pg_sql.SQL("CREATE INDEX ON {tbl} ({columns});")
+_SQL_DROP_TABLE = pg_sql.SQL("DROP TABLE {tbl};")
+
 
 def log_sql(sql):
     _log.debug('SQL: {}'.format(sql))
@@ -22,16 +42,33 @@ def exec_sql(cursor, sql):
     cursor.execute(sql)
 
 
+def exec_sql_batch(cursor, sql_statements):
+    """
+    Execute multiple statements as a single command so only one round trip to the server is paid.
+    Note that cursor.rowcount will reflect only the last statement of the batch.
+    """
+    exec_sql(cursor, "\n".join(
+        stmt if stmt.rstrip().endswith(';') else stmt + ';' for stmt in sql_statements))
+
+
+def sql_row_hash(table_name, column_names):
+    """
+    Expression that hashes the text form of the given columns of a row. Comparing hashes treats
+    NULLs as equal (similar to "IS NOT DISTINCT FROM", which also handles NULLs but can't use
+    hash or index-based plans) and gives the planner a single equality predicate to work with.
+    """
+    row_sql = ",".join(["{tbl}.{col}".format(tbl=table_name, col=col) for col in column_names])
+    return _SQL_ROW_HASH.format(row_sql=row_sql)
+
+
 def sql_delete_identical_rows_between_tables(delete_table_name, reference_table_name, all_column_names):
-    # "IS NOT DISTINCT FROM" handles NULLS better (even composite type columns), but is not indexed
-    # where_clause = " AND ".join(["%s.%s IS NOT DISTINCT FROM %s.%s" % (table, col, temp_table_name, col)
-    #                               for col in all_columns])
-    where_clause = " AND ".join(
-        ["({ref}.{col} = {dlt}.{col} OR ({ref}.{col} IS NULL AND {dlt}.{col} IS NULL))".format(
-            ref=reference_table_name, col=col, dlt=delete_table_name) for col in all_column_names])
-
-    delete_sql = "DELETE FROM {dlt} USING {ref} WHERE {where_clause};".format(
-        dlt=delete_table_name, ref=reference_table_name, where_clause=where_clause)
+    # Compare rows by a hash over all columns instead of a per-column
+    # "(a = b OR (a IS NULL AND b IS NULL))" clause: a single hashable equality predicate lets
+    # the planner use a hash join instead of being forced into a nested loop
+    delete_sql = _SQL_DELETE_IDENTICAL_ROWS.format(
+        dlt=delete_table_name, ref=reference_table_name,
+        dlt_hash=sql_row_hash(delete_table_name, all_column_names),
+        ref_hash=sql_row_hash(reference_table_name, all_column_names))
     return delete_sql
 
 
@@ -40,14 +77,18 @@ def sql_insert_rows_not_in_table(insert_table_name, reference_table_name, id_col
                                   for col in id_column_names])
     reference_table_cols = ",".join(["{tbl}.{col}".format(tbl=reference_table_name, col=col)
                                      for col in id_column_names])
+    # Select the columns explicitly (instead of "ref.*") so that only the inserted columns are
+    # read and their order is guaranteed to match the INSERT's column list
+    select_columns = ",".join(["{tbl}.{col}".format(tbl=reference_table_name, col=col)
+                               for col in column_names])
     # The left join will give nulls for the joined table when no matches are found.
     # We use '(tuple) is null' to see if all columns (values in the tuple) are null.
-    select_sql = "SELECT {ref}.* FROM {ref} LEFT JOIN {ins} ON ({ins_cols}) = ({ref_cols}) WHERE ({ins_cols}) is NULL"\
-        .format(ref=reference_table_name, ins=insert_table_name,
-                ins_cols=insert_table_cols, ref_cols=reference_table_cols)
+    select_sql = _SQL_SELECT_MISSING_ROWS.format(
+        sel_cols=select_columns, ref=reference_table_name, ins=insert_table_name,
+        ins_cols=insert_table_cols, ref_cols=reference_table_cols)
     columns_sql = ','.join(column_names)
 
-    insert_sql = "INSERT INTO {ins}({cols}) ({select_sql}) RETURNING NULL;".format(
+    insert_sql = _SQL_INSERT_MISSING_ROWS.format(
         ins=insert_table_name, cols=columns_sql, select_sql=select_sql)
     return insert_sql
 
@@ -59,13 +100,13 @@ def sql_update_rows_between_tables(update_table_name, reference_table_name, id_c
                             for col in all_column_names])
     where_clause = " AND ".join(["{}.{} = {}.{}".format(update_table_name, col, reference_table_name, col)
                                  for col in id_column_names])
-    update_sql = "UPDATE {upd} SET {set_columns} FROM {ref} WHERE {where_clause};".format(
+    update_sql = _SQL_UPDATE_MATCHING_ROWS.format(
         upd=update_table_name, set_columns=set_columns, ref=reference_table_name, where_clause=where_clause)
     return update_sql
 
 
 def pg_upsert(inspector, cursor, schema, dest_table, input_file, file_format=None, file_config=None,
-              config_per_table=None):
+              config_per_table=None, all_column_names=None, unique_columns=None):
     """
     Postgresql 9.5+ includes merge/upsert with INSERT ... ON CONFLICT, but it requires columns to have unique
     constraints (or even a partial unique index). We might use it once we're sure that it covers all our use cases.
@@ -79,19 +120,30 @@ def pg_upsert(inspector, cursor, schema, dest_table, input_file, file_format=Non
     :param file_config: Config for the file being imported
     :param config_per_table: Config for all tables. Will be used in case of foreign keys to other tables.
                              Also used if file_config is None.
+    :param all_column_names: Column names of the destination table, if already known. Saves a
+                             round trip to re-inspect the table.
+    :param unique_columns: Primary key and unique constraint columns of the destination table,
+                           if already known. Saves round trips to re-inspect the table.
     :return:
     """
-    # Determine default values if needed
-    file_format = "FORMAT CSV, HEADER, ENCODING 'UTF8'" if file_format is None else file_format
+    # Determine default values if needed: files exported with PostgreSQL's binary format are
+    # detected by their extension
+    is_binary = input_file.endswith(('.bin', '.bin.gz'))
+    if file_format is None:
+        file_format = BINARY_FILE_FORMAT if is_binary else DEFAULT_FILE_FORMAT
 
     config_per_table = {} if config_per_table is None else config_per_table
     file_config = config_per_table.get(dest_table, {}) if file_config is None else file_config
     columns = file_config.get('columns', None)
     alternate_key = file_config.get('alternate_key', None)
 
-    all_columns = [col['name'] for col in inspector.get_columns(dest_table, schema)]
+    if all_column_names is None:
+        all_column_names = [col['name'] for col in inspector.get_columns(dest_table, schema)]
+    all_columns = all_column_names
     columns = all_columns if columns is None else columns
-    id_columns = get_unique_columns(inspector, dest_table, schema) if alternate_key is None else alternate_key
+    if unique_columns is None:
+        unique_columns = get_unique_columns(inspector, dest_table, schema)
+    id_columns = unique_columns if alternate_key is None else alternate_key
     # Table should either be setup correctly, or alternate key should be specified
     if len(id_columns) == 0:
         raise UnsupportedSchemaException("Table has no primary key or unique columns!")
@@ -114,67 +166,90 @@ def pg_upsert(inspector, cursor, schema, dest_table, input_file, file_format=Non
                                                                 schema, dest_table, columns)
     select_sql = sql_select_table_with_foreign_columns(inspector, schema, dest_table, foreign_columns)
     # Create temporary table with same columns and types as target table
-    create_sql = "CREATE TEMP TABLE {tmp_copy} AS {select_sql} LIMIT 0;".format(
-        tmp_copy=table_name_tmp_copy, select_sql=select_sql)
+    create_sql = _SQL_CREATE_TMP_COPY.format(
+        tmp_copy=pg_sql.Identifier(table_name_tmp_copy),
+        select_sql=pg_sql.SQL(select_sql)).as_string(cursor)
     exec_sql(cursor, create_sql)
     # Import data into temporary table
-    copy_sql = 'COPY {tbl} FROM STDOUT WITH ({format});'.format(tbl=table_name_tmp_copy, format=file_format)
+    copy_sql = _SQL_COPY_FROM.format(
+        tbl=pg_sql.Identifier(table_name_tmp_copy),
+        file_format=pg_sql.SQL(file_format)).as_string(cursor)
     log_sql(copy_sql)
 
-    with open(input_file, 'r', encoding="utf-8") as input_file:
-        cursor.copy_expert(copy_sql, input_file)
+    if input_file.endswith('.gz'):
+        file_handle = gzip.open(input_file, 'rb') if is_binary \
+            else gzip.open(input_file, 'rt', encoding="utf-8")
+    elif is_binary:
+        file_handle = open(input_file, 'rb')
+    else:
+        file_handle = open(input_file, 'r', encoding="utf-8")
+    with file_handle:
+        cursor.copy_expert(copy_sql, file_handle)
     stats['total'] = cursor.rowcount
 
     # Run analyze to improve performance after populating temporary table.
     # See: https://www.postgresql.org/docs/current/sql-createtable.html#SQL-CREATETABLE-TEMPORARY
     # and: https://www.postgresql.org/docs/current/populate.html#POPULATE-ANALYZE
-    analyze_sql = "ANALYZE {tmp_copy}".format(tmp_copy=table_name_tmp_copy)
-    exec_sql(cursor, analyze_sql)
+    analyze_sql = _SQL_ANALYZE.format(tbl=pg_sql.Identifier(table_name_tmp_copy)).as_string(cursor)
 
     # select_sql = sql_select_table_with_foreign_columns(inspector, schema, dest_table)
     table_name_tmp_final = "_tmp_final_{}".format(dest_table)
     select_sql = sql_select_table_with_local_columns(inspector, schema, dest_table,
                                                      table_name_tmp_copy, foreign_columns,
                                                      config_per_table)
-    create_sql = "CREATE TEMP TABLE {tmp_final} AS {select_sql};".format(
-        tmp_final=table_name_tmp_final, select_sql=select_sql)
-    exec_sql(cursor, create_sql)
+    create_sql = _SQL_CREATE_TMP_FINAL.format(
+        tmp_final=pg_sql.Identifier(table_name_tmp_final),
+        select_sql=pg_sql.SQL(select_sql)).as_string(cursor)
     # Add index so that comparison for identical rows is much faster
-    index_sql = "CREATE INDEX ON {} ({});".format(table_name_tmp_final,
-                                                  ",".join(id_columns))
-    exec_sql(cursor, index_sql)
+    index_sql = _SQL_CREATE_INDEX.format(
+        tbl=pg_sql.Identifier(table_name_tmp_final),
+        columns=pg_sql.SQL(",".join(id_columns))).as_string(cursor)
+    exec_sql_batch(cursor, [analyze_sql, create_sql, index_sql])
 
     upsert_stats = upsert_table_to_table(cursor, table_name_tmp_final, dest_table, id_columns, columns)
     stats.update(upsert_stats)
 
-    drop_sql = "DROP TABLE {};".format(table_name_tmp_copy)
-    exec_sql(cursor, drop_sql)
+    # Clean up both temporary tables and run analyze to improve performance after populating
+    # the destination table
+    exec_sql_batch(cursor, [
+        _SQL_DROP_TABLE.format(tbl=pg_sql.Identifier(table_name_tmp_copy)).as_string(cursor),
+        _SQL_DROP_TABLE.format(tbl=pg_sql.Identifier(table_name_tmp_final)).as_string(cursor),
+        _SQL_ANALYZE.format(tbl=pg_sql.Identifier(dest_table)).as_string(cursor),
+    ])
 
-    drop_sql = "DROP TABLE {};".format(table_name_tmp_final)
-    exec_sql(cursor, drop_sql)
+    return stats
 
-    # Run analyze to improve performance after populating table.
-    analyze_sql = "ANALYZE {}".format(dest_table)
-    exec_sql(cursor, analyze_sql)
 
-    return stats
+@functools.lru_cache(maxsize=None)
+def _build_upsert_sql(src_table, dest_table, id_columns, columns):
+    """
+    Build the delete/insert/update statements used to upsert one table into another. Memoized
+    since the generated SQL only depends on the table names and column tuples, and the same
+    shape recurs when a table is imported multiple times (e.g. once per subset file).
+    """
+    return (sql_delete_identical_rows_between_tables(src_table, dest_table, columns),
+            sql_insert_rows_not_in_table(dest_table, src_table, id_columns, columns),
+            sql_update_rows_between_tables(dest_table, src_table, id_columns, columns))
 
 
 def upsert_table_to_table(cursor, src_table, dest_table, id_columns, columns):
     stats = {'skip': 0, 'insert': 0, 'update': 0}
 
+    delete_sql, insert_sql, update_sql = _build_upsert_sql(src_table, dest_table,
+                                                           tuple(id_columns), tuple(columns))
+
     # Delete rows in temp table that are already identical to those in destination table
-    exec_sql(cursor, sql_delete_identical_rows_between_tables(src_table, dest_table, columns))
+    exec_sql(cursor, delete_sql)
     stats['skip'] = cursor.rowcount
 
     # Insert rows from temp table that are not in destination table (according to id columns)
-    exec_sql(cursor, sql_insert_rows_not_in_table(dest_table, src_table, id_columns, columns))
+    exec_sql(cursor, insert_sql)
     stats['insert'] = cursor.rowcount
-    # Delete rows that were just inserted
-    exec_sql(cursor, sql_delete_identical_rows_between_tables(src_table, dest_table, columns))
 
-    # Update rows whose id columns match in destination table
-    exec_sql(cursor, sql_update_rows_between_tables(dest_table, src_table, id_columns, columns))
+    # Delete rows that were just inserted and then update rows whose id columns match in the
+    # destination table. These are batched since only the UPDATE's rowcount is needed and
+    # cursor.rowcount reflects the last statement of a batch.
+    exec_sql_batch(cursor, [delete_sql, update_sql])
     stats['update'] = cursor.rowcount
 
     return stats
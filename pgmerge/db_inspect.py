@@ -35,7 +35,7 @@ def print_cycle_info_and_break_cycles(table_graph):
     """
     Changes given graph by breaking cycles
     """
-    simple_cycles = list(nx.simple_cycles(table_graph))
+    simple_cycles = db_graph.get_cycles(table_graph)
     if len(simple_cycles) > 0:
         print("\n%s self-references and simple cycles found:" % (len(simple_cycles),))
         print(simple_cycles)
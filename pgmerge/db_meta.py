@@ -0,0 +1,212 @@
+"""
+pgmerge - a PostgreSQL data import and merge utility
+
+Copyright 2018-2020 Simon Muller (samullers@gmail.com)
+"""
+import logging
+import weakref
+from collections import defaultdict
+
+_log = logging.getLogger(__name__)
+
+
+class SchemaCache:
+    """
+    Memoizes schema introspection done via SQLAlchemy's inspector so that repeated lookups for the
+    same table don't each re-query the database's information schema. Can be used as a drop-in
+    replacement for the inspector wherever only introspection methods are called.
+
+    The cache is meant to live only as long as a database session: create one per connection and,
+    if the connection is given, the cache is cleared when the connection gets garbage collected.
+    """
+
+    def __init__(self, inspector, connection=None):
+        self._inspector = inspector
+        self._tables = {}
+        self._columns = {}
+        self._pks = {}
+        self._uniques = {}
+        self._fks = {}
+        if connection is not None:
+            weakref.finalize(connection, self.clear)
+
+    def clear(self):
+        self._tables.clear()
+        self._columns.clear()
+        self._pks.clear()
+        self._uniques.clear()
+        self._fks.clear()
+
+    def get_table_names(self, schema):
+        if schema not in self._tables:
+            self._tables[schema] = self._inspector.get_table_names(schema)
+        return self._tables[schema]
+
+    def get_columns(self, table, schema):
+        if (schema, table) not in self._columns:
+            self._columns[(schema, table)] = self._inspector.get_columns(table, schema)
+        return self._columns[(schema, table)]
+
+    def get_pk_constraint(self, table, schema):
+        if (schema, table) not in self._pks:
+            self._pks[(schema, table)] = self._inspector.get_pk_constraint(table, schema)
+        return self._pks[(schema, table)]
+
+    def get_unique_constraints(self, table, schema):
+        if (schema, table) not in self._uniques:
+            self._uniques[(schema, table)] = self._inspector.get_unique_constraints(table, schema)
+        return self._uniques[(schema, table)]
+
+    def get_foreign_keys(self, table, schema):
+        if (schema, table) not in self._fks:
+            self._fks[(schema, table)] = self._inspector.get_foreign_keys(table, schema)
+        return self._fks[(schema, table)]
+
+    @property
+    def bind(self):
+        return self._inspector.bind
+
+
+def log_sql(sql):
+    _log.debug('SQL: {}'.format(sql))
+
+
+def exec_sql(cursor, sql, params=None):
+    log_sql(sql)
+    cursor.execute(sql, params)
+
+
+# Query templates are built once at import time so no per-call string construction is needed
+_SQL_ALL_FOREIGN_KEYS = """
+        SELECT con.conname AS name,
+            rel.relname AS table_name,
+            array_agg(att.attname ORDER BY cols.ord) AS constrained_columns,
+            fnsp.nspname AS referred_schema,
+            frel.relname AS referred_table,
+            array_agg(fatt.attname ORDER BY cols.ord) AS referred_columns
+        FROM pg_constraint con
+            JOIN pg_class rel ON rel.oid = con.conrelid
+            JOIN pg_namespace nsp ON nsp.oid = rel.relnamespace
+            JOIN pg_class frel ON frel.oid = con.confrelid
+            JOIN pg_namespace fnsp ON fnsp.oid = frel.relnamespace
+            CROSS JOIN LATERAL unnest(con.conkey, con.confkey)
+                WITH ORDINALITY AS cols(attnum, fattnum, ord)
+            JOIN pg_attribute att ON att.attrelid = con.conrelid AND att.attnum = cols.attnum
+            JOIN pg_attribute fatt ON fatt.attrelid = con.confrelid AND fatt.attnum = cols.fattnum
+        WHERE con.contype = 'f' AND nsp.nspname = %(schema)s
+        GROUP BY con.conname, rel.relname, fnsp.nspname, frel.relname
+        ORDER BY rel.relname, con.conname
+    """
+
+
+def sql_all_foreign_keys():
+    """
+    Query that returns one row per foreign key for all tables in a schema. Columns are returned
+    as arrays ordered by their position in the constraint so that constrained and referred
+    columns line up.
+
+    Only supports PostgreSQL since it queries the pg_catalog tables directly.
+    """
+    return _SQL_ALL_FOREIGN_KEYS
+
+
+def get_all_foreign_keys(cursor, schema):
+    """
+    Fetch the foreign keys of all tables in the given schema with a single query.
+
+    Returns a dictionary that maps each table name to a list of foreign keys in the same format
+    as SQLAlchemy's inspector.get_foreign_keys(). Tables without foreign keys aren't included.
+    """
+    exec_sql(cursor, sql_all_foreign_keys(), {'schema': schema})
+    fks_per_table = defaultdict(list)
+    for name, table, constrained_columns, referred_schema, referred_table, referred_columns in cursor.fetchall():
+        fks_per_table[table].append(_foreign_key_from_row(
+            name, constrained_columns, referred_schema, referred_table, referred_columns))
+    return fks_per_table
+
+
+def _foreign_key_from_row(name, constrained_columns, referred_schema, referred_table, referred_columns):
+    return {
+        'name': name,
+        'constrained_columns': list(constrained_columns),
+        'referred_schema': referred_schema,
+        'referred_table': referred_table,
+        'referred_columns': list(referred_columns),
+    }
+
+
+_SQL_ALL_SCHEMA_METADATA = """
+        WITH cols AS (
+            SELECT rel.relname AS table_name,
+                array_agg(att.attname ORDER BY att.attnum) AS columns
+            FROM pg_class rel
+                JOIN pg_namespace nsp ON nsp.oid = rel.relnamespace
+                JOIN pg_attribute att ON att.attrelid = rel.oid
+                    AND att.attnum > 0 AND NOT att.attisdropped
+            WHERE rel.relkind IN ('r', 'p') AND nsp.nspname = %(schema)s
+            GROUP BY rel.relname
+        ), keys AS (
+            SELECT con.contype AS contype,
+                rel.relname AS table_name,
+                con.conname AS name,
+                array_agg(att.attname ORDER BY cols.ord) AS columns
+            FROM pg_constraint con
+                JOIN pg_class rel ON rel.oid = con.conrelid
+                JOIN pg_namespace nsp ON nsp.oid = rel.relnamespace
+                CROSS JOIN LATERAL unnest(con.conkey)
+                    WITH ORDINALITY AS cols(attnum, ord)
+                JOIN pg_attribute att ON att.attrelid = con.conrelid AND att.attnum = cols.attnum
+            WHERE con.contype IN ('p', 'u') AND nsp.nspname = %(schema)s
+            GROUP BY con.contype, rel.relname, con.conname
+        ), fks AS (
+            {fks_sql}
+        )
+        SELECT 'column' AS kind, table_name, NULL AS name, columns,
+            NULL AS referred_schema, NULL AS referred_table, NULL::name[] AS referred_columns
+        FROM cols
+        UNION ALL
+        SELECT CASE contype WHEN 'p' THEN 'pk' ELSE 'uk' END, table_name, name, columns,
+            NULL, NULL, NULL::name[]
+        FROM keys
+        UNION ALL
+        SELECT 'fk', table_name, name, constrained_columns,
+            referred_schema, referred_table, referred_columns
+        FROM fks
+        ORDER BY kind, table_name, name
+    """.format(fks_sql=_SQL_ALL_FOREIGN_KEYS)
+
+
+def sql_all_schema_metadata():
+    """
+    Query that fuses all the metadata needed to import into a schema (columns, primary keys,
+    unique constraints and foreign keys of every table) into a single round trip. Each row is
+    tagged with a 'kind' discriminator column so that it can be dispatched client-side.
+    """
+    return _SQL_ALL_SCHEMA_METADATA
+
+
+def get_all_schema_metadata(cursor, schema):
+    """
+    Fetch the columns, primary keys, unique constraints and foreign keys of all tables in the
+    given schema with a single query.
+
+    Returns a dictionary that maps each table name to a dictionary with the following keys:
+        'columns': column names ordered by their position in the table
+        'pks': column names of the primary key
+        'uniques': a list of {'name', 'column_names'} dictionaries, one per unique constraint
+        'fks': a list of foreign keys in the same format as inspector.get_foreign_keys()
+    """
+    exec_sql(cursor, sql_all_schema_metadata(), {'schema': schema})
+    metadata_per_table = defaultdict(lambda: {'columns': [], 'pks': [], 'uniques': [], 'fks': []})
+    for kind, table, name, columns, referred_schema, referred_table, referred_columns in cursor.fetchall():
+        table_metadata = metadata_per_table[table]
+        if kind == 'column':
+            table_metadata['columns'] = list(columns)
+        elif kind == 'pk':
+            table_metadata['pks'] = list(columns)
+        elif kind == 'uk':
+            table_metadata['uniques'].append({'name': name, 'column_names': list(columns)})
+        elif kind == 'fk':
+            table_metadata['fks'].append(_foreign_key_from_row(
+                name, columns, referred_schema, referred_table, referred_columns))
+    return metadata_per_table
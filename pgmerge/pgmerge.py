@@ -9,25 +9,57 @@ import re
 import sys
 import copy
 import errno
+import atexit
 import logging
+from collections import Counter
 from logging.handlers import RotatingFileHandler
 
 import click
 import sqlalchemy
+from sqlalchemy.pool import QueuePool
 from appdirs import user_log_dir
 
-from .utils import decorate, NoExceptionFormatter, only_file_stem
+from .utils import decorate, NoExceptionFormatter, only_file_stem, list_files
 from .db_config import load_config_for_tables, \
     validate_table_configs_with_schema, \
     retrieve_password, generate_url, \
     ConfigInvalidException
-from . import db_graph, db_import, db_export, db_inspect, __version__
+from . import db_graph, db_import, db_export, db_inspect, db_meta, __version__
 
 APP_NAME = "pgmerge"
 LOG_FILE = os.path.join(user_log_dir(APP_NAME, appauthor=False), "out.log")
+# File extensions recognized for import, in order of preference when multiple files exist
+IMPORT_FILE_EXTENSIONS = ['.csv', '.csv.gz', '.bin', '.bin.gz']
 
 log = logging.getLogger()
 
+# Engines are cached per URL and re-used between commands run in the same process so that their
+# pooled connections can skip the TCP and authentication handshake of a new connection
+_engines_per_url = {}
+
+
+def get_engine(db_url):
+    """
+    Get a cached engine for the given URL, creating it with a connection pool if it doesn't
+    exist yet.
+    """
+    if db_url not in _engines_per_url:
+        _engines_per_url[db_url] = sqlalchemy.create_engine(
+            db_url, poolclass=QueuePool, pool_size=5, pool_pre_ping=True)
+    return _engines_per_url[db_url]
+
+
+def dispose_engines():
+    """
+    Close the pooled connections of all cached engines.
+    """
+    for engine in _engines_per_url.values():
+        engine.dispose()
+    _engines_per_url.clear()
+
+
+atexit.register(dispose_engines)
+
 
 def setup_logging(verbose=False): # pragma: no cover
     log_dir = os.path.dirname(LOG_FILE)
@@ -134,16 +166,26 @@ def import_all_new(connection, inspector, schema, import_files, dest_tables, con
 
     cursor = connection.cursor()
 
-    tables = sorted(inspector.get_table_names(schema))
+    # Memoize introspection for the duration of this session since the same tables are
+    # inspected multiple times during import
+    inspector = db_meta.SchemaCache(inspector, connection)
+
+    # Fetch the columns, keys and foreign keys of all tables up-front with a single fused query
+    # instead of issuing several introspection queries per table
+    metadata_per_table = db_meta.get_all_schema_metadata(cursor, schema)
+    fks_per_table = {table: metadata['fks'] for table, metadata in metadata_per_table.items()}
+
+    tables = sorted(metadata_per_table)
     unknown_tables = get_and_warn_about_any_unknown_tables(import_files, dest_tables, tables)
 
-    table_graph = db_graph.build_fk_dependency_graph(inspector, schema, tables=None)
+    table_graph = db_graph.build_fk_dependency_graph(inspector, schema, tables=tables,
+                                                     fks_per_table=fks_per_table)
     # Sort by dependency requirements
     insertion_order = db_graph.get_insertion_order(table_graph)
     import_pairs = list(zip(import_files, dest_tables))
     import_pairs.sort(key=lambda pair: insertion_order.index(pair[1]))
-    # Stats
-    total_stats = {'skip': 0, 'insert': 0, 'update': 0, 'total': 0}
+    # Stats (Counter sums values on update and returns 0 for missing keys)
+    total_stats = Counter()
     error_tables = list(unknown_tables)
 
     if suspend_foreign_keys:
@@ -158,9 +200,17 @@ def import_all_new(connection, inspector, schema, import_files, dest_tables, con
 
         subset_name = only_file_stem(file)
         file_config = config_per_subset.get(subset_name, None)
+        table_metadata = metadata_per_table.get(table, None)
+        all_column_names = None
+        unique_columns = None
+        if table_metadata is not None:
+            all_column_names = table_metadata['columns']
+            unique_columns = table_metadata['pks'] + [
+                col for unique in table_metadata['uniques'] for col in unique['column_names']]
         try:
             stats = db_import.pg_upsert(inspector, cursor, schema, table, file, file_format,
-                                        file_config=file_config, config_per_table=config_per_table)
+                                        file_config=file_config, config_per_table=config_per_table,
+                                        all_column_names=all_column_names, unique_columns=unique_columns)
         except db_import.UnsupportedSchemaException as exc:
             print("\tSkipping table with unsupported schema: {}".format(exc))
             error_tables.append(table)
@@ -172,7 +222,7 @@ def import_all_new(connection, inspector, schema, import_files, dest_tables, con
             click.secho(stat_output, fg='green')
         else:
             print(stat_output)
-        total_stats = {k: total_stats.get(k, 0) + stats.get(k, 0) for k in set(total_stats) | set(stats)}
+        total_stats.update(stats)
 
     if suspend_foreign_keys:
         db_import.enable_foreign_key_constraints(cursor)
@@ -197,34 +247,50 @@ def run_in_session(engine, func):
         conn.close()
 
 
+def find_file_for_table(table, all_files):
+    """
+    Find the file to import for the given table by trying each supported extension in order of
+    preference. Defaults to the plain CSV name if no file is found (so that the normal "file is
+    missing" handling applies).
+    """
+    for extension in IMPORT_FILE_EXTENSIONS:
+        if table + extension in all_files:
+            return table + extension
+    return table + '.csv'
+
+
 def get_import_files_and_tables(directory, tables, config_per_table):
     if config_per_table is None:
         config_per_table = {}
 
     # Determine tables based on files in directory
-    all_files = sorted([f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))])
-    import_files = [f for f in all_files if re.match(r".*\.csv", f)]
-    dest_tables = [f[:-len('.csv')] for f in import_files]
+    all_files = list_files(directory)
+    import_files = [f for f in all_files if re.match(r".*\.(csv|bin)(\.gz)?$", f)]
+    # If a file exists with more than one supported extension (e.g. exports both with and without
+    # --compress), only keep the preferred one so the table isn't imported twice
+    import_files = [f for f in import_files if f == find_file_for_table(only_file_stem(f), all_files)]
+    dest_tables = [only_file_stem(f) for f in import_files]
 
     # Consider subsets in config
     subsets = {table: [subset['name'] for subset in config_per_table[table]['subsets']]
                for table in config_per_table if 'subsets' in config_per_table[table]}
     subset_files = {filename: table for table in subsets for filename in subsets[table]}
     for subset_name in subset_files:
-        filename = subset_name + '.csv'
         actual_table = subset_files[subset_name]
-        if filename in import_files:
-            # Update dest_tables with correct table
-            dest_tables[import_files.index(filename)] = actual_table
+        for extension in IMPORT_FILE_EXTENSIONS:
+            filename = subset_name + extension
+            if filename in import_files:
+                # Update dest_tables with correct table
+                dest_tables[import_files.index(filename)] = actual_table
 
     if tables is not None and len(tables) != 0:
         # Use only selected tables
-        import_files = ["%s.csv" % (table,) for table in tables]
+        import_files = [find_file_for_table(table, all_files) for table in tables]
         dest_tables = tables
 
     # Check that all expected files exist
-    expected_table_files = ["%s.csv" % (table,) for table in dest_tables]
-    unknown_files = set(expected_table_files).difference(set(all_files))
+    unknown_files = {"%s.csv" % (table,) for table in dest_tables
+                     if not any(table + extension in all_files for extension in IMPORT_FILE_EXTENSIONS)}
     if len(unknown_files) > 0:
         print("No files found for the following tables:")
         for file in unknown_files:
@@ -312,8 +378,8 @@ def generate_single_table_config(directory, tables, config_per_table):
     assert len(tables) == 1
     table_name = tables[0]
 
-    all_files = sorted([f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))])
-    import_files = [f for f in all_files if re.match(r".*\.csv", f)]
+    all_files = list_files(directory)
+    import_files = [f for f in all_files if re.match(r".*\.(csv|bin)(\.gz)?$", f)]
 
     # Add subsets to config if they don't already exist
     if 'subsets' not in config_per_table[table_name]:
@@ -369,9 +435,15 @@ def main(verbose):
 
 @main.command()
 @decorate(DB_CONNECT_OPTIONS)
+@click.option('--compress', '-z', is_flag=True,
+              help='Compress exported files with gzip (creates .csv.gz files that can also ' +
+              'be imported directly).')
+@click.option('--binary', '-b', is_flag=True,
+              help='Export in PostgreSQL\'s binary format (creates .bin files that can also be ' +
+              'imported directly). Smaller and faster for wide tables, but less portable than CSV.')
 @decorate(DIR_TABLES_ARGUMENTS)
 def export(dbname, uri, host, port, username, no_password, password, schema,
-           config, include_dependent_tables,
+           config, include_dependent_tables, compress, binary,
            directory, tables):
     """
     Export each table to a CSV file.
@@ -379,13 +451,12 @@ def export(dbname, uri, host, port, username, no_password, password, schema,
     If one or more tables are specified then only they will be used, otherwise all tables found will be selected. They
     will all be exported into the given directory.
     """
-    engine = None
     try:
         if uri:
             no_password = True
         password = retrieve_password(APP_NAME, dbname, host, port, username, password, never_prompt=no_password)
         db_url = generate_url(uri, dbname, host, port, username, password)
-        engine = sqlalchemy.create_engine(db_url)
+        engine = get_engine(db_url)
         inspector = sqlalchemy.inspect(engine)
         schema = validate_schema(inspector, schema)
         table_graph = db_graph.build_fk_dependency_graph(inspector, schema, tables=None)
@@ -398,16 +469,12 @@ def export(dbname, uri, host, port, username, no_password, password, schema,
         config_per_table = load_table_config_or_exit(inspector, schema, config)
         find_and_warn_about_cycles(table_graph, tables)
 
-        def export_tables(conn):
-            return db_export.export_tables_per_config(conn, inspector, schema, directory, tables,
-                                                      config_per_table=config_per_table)
-        table_count, file_count = run_in_session(engine, export_tables)
+        table_count, file_count = db_export.export_tables_per_config(
+            engine, inspector, schema, directory, tables, config_per_table=config_per_table,
+            compress=compress, binary=binary)
         print("Exported {} tables to {} files".format(table_count, file_count))
     except Exception as exc:
         logging.exception(exc)
-    finally:
-        if engine is not None:
-            engine.dispose()
 
 
 @main.command(name="import")
@@ -432,13 +499,12 @@ def upsert(dbname, uri, host, port, username, no_password, password, schema,
     If one or more tables are specified then only they will be used, otherwise all tables
     found will be selected.
     """
-    engine = None
     try:
         if uri:
             no_password = True
         password = retrieve_password(APP_NAME, dbname, host, port, username, password, never_prompt=no_password)
         db_url = generate_url(uri, dbname, host, port, username, password)
-        engine = sqlalchemy.create_engine(db_url)
+        engine = get_engine(db_url)
         inspector = sqlalchemy.inspect(engine)
         schema = validate_schema(inspector, schema)
         table_graph = db_graph.build_fk_dependency_graph(inspector, schema, tables=None)
@@ -466,9 +532,6 @@ def upsert(dbname, uri, host, port, username, no_password, password, schema,
                                       fail_on_warning=not ignore_cycles))
     except Exception as exc:
         logging.exception(exc)
-    finally:
-        if engine is not None:
-            engine.dispose()
 
 
 @main.command(context_settings=dict(max_content_width=120))
@@ -498,21 +561,17 @@ def inspect(engine, dbname, uri, host, port, username, no_password, password, sc
     Defaults to PostgreSQL but should support multiple database engines thanks to SQLAlchemy (see:
     http://docs.sqlalchemy.org/en/latest/dialects/).
     """
-    _engine = None
     try:
         if uri:
             no_password = True
         password = retrieve_password(APP_NAME, dbname, host, port, username, password, never_prompt=no_password)
         db_url = generate_url(uri, dbname, host, port, username, password, type=engine)
-        _engine = sqlalchemy.create_engine(db_url)
+        _engine = get_engine(db_url)
         db_inspect.main(_engine, schema,
                         warnings, list_tables, table_details, partition,
                         cycles, insert_order, export_graph, transferable)
     except Exception as exc:
         logging.exception(exc)
-    finally:
-        if _engine is not None:
-            _engine.dispose()
 
 
 if __name__ == "__main__":
@@ -153,6 +153,36 @@ class TestCLI(TestDB):
 
             os.remove(os.path.join(self.output_dir, "{}.csv".format(table_name)))
 
+    def test_export_and_import_compressed(self):
+        """
+        Test exporting with gzip compression and immediately importing the compressed file.
+        """
+        table_name = 'country'
+        table = Table(table_name, MetaData(),
+                      Column('code', String(2), primary_key=True),
+                      Column('name', String, nullable=False))
+        with create_table(self.engine, table):
+            stmt = table.insert(None).values([
+                ('CI', 'Côte d’Ivoire'),
+                ('RE', 'Réunion'),
+                ('ST', 'São Tomé and Príncipe')
+            ])
+            self.connection.execute(stmt)
+
+            result = self.runner.invoke(pgmerge.export, ['--compress', '--dbname', self.db_name,
+                                                         '--uri', self.url, self.output_dir])
+            self.assertEqual(result.output, "Exported 1 tables to 1 files\n")
+
+            result = self.runner.invoke(pgmerge.upsert, ['--dbname', self.db_name, '--uri', self.url,
+                                                         self.output_dir, table_name])
+            # Since data hasn't changed, the import should change nothing. All lines should be skipped.
+            self.compare_table_output(result.output, [
+                ["country:"],
+                ["skip:", "3", "insert:", "0", "update:", "0"],
+            ], "1 tables imported successfully")
+
+            os.remove(os.path.join(self.output_dir, "{}.csv.gz".format(table_name)))
+
     def test_merge(self):
         """
         Test insert and update (merge) by exporting data, clearing table and then importing into a table with
@@ -198,6 +228,83 @@ class TestCLI(TestDB):
 
         os.remove(os.path.join(self.output_dir, "{}.csv".format(table_name)))
 
+    def test_merge_binary(self):
+        """
+        Test a merge via PostgreSQL's binary format by exporting data, clearing the table and then
+        importing into a table with slightly different data.
+        """
+        table_name = 'country'
+        table = Table(table_name, MetaData(),
+                      Column('code', String(2), primary_key=True),
+                      Column('name', String, nullable=False))
+        # Create table with data to export
+        with create_table(self.engine, table):
+            stmt = table.insert(None).values([
+                ('CI', 'Côte d’Ivoire'),
+                ('EG', 'Egypt'),
+                ('RE', 'Réunion'),
+            ])
+            self.connection.execute(stmt)
+
+            result = self.runner.invoke(pgmerge.export, ['--binary', '--dbname', self.db_name,
+                                                         '--uri', self.url, self.output_dir])
+            self.assertEqual(result.output, "Exported 1 tables to 1 files\n")
+        # Import the exported data into a table with different data
+        with create_table(self.engine, table):
+            stmt = table.insert(None).values([
+                ('EG', 'Egypt'),
+                ('RE', 'Re-union'),
+                ('ST', 'São Tomé and Príncipe'),
+            ])
+            self.connection.execute(stmt)
+
+            result = self.runner.invoke(pgmerge.upsert, ['--dbname', self.db_name, '--uri', self.url,
+                                                         self.output_dir, table_name])
+            self.compare_table_output(result.output, [
+                ["country:"],
+                ["skip:", "1", "insert:", "1", "update:", "1"],
+            ], "1 tables imported successfully")
+
+            stmt = select([table]).order_by('code')
+            result = self.connection.execute(stmt)
+            self.assertEqual(result.fetchall(), [
+                ('CI', 'Côte d’Ivoire'), ('EG', 'Egypt'), ('RE', 'Réunion'), ('ST', 'São Tomé and Príncipe')])
+            result.close()
+            # Select requires us to close the connection before dropping the table
+            self.connection.close()
+
+        os.remove(os.path.join(self.output_dir, "{}.bin".format(table_name)))
+
+    def test_export_and_import_binary_compressed(self):
+        """
+        Test exporting in compressed binary format and immediately importing the exported file.
+        """
+        table_name = 'country'
+        table = Table(table_name, MetaData(),
+                      Column('code', String(2), primary_key=True),
+                      Column('name', String, nullable=False))
+        with create_table(self.engine, table):
+            stmt = table.insert(None).values([
+                ('CI', 'Côte d’Ivoire'),
+                ('RE', 'Réunion'),
+                ('ST', 'São Tomé and Príncipe')
+            ])
+            self.connection.execute(stmt)
+
+            result = self.runner.invoke(pgmerge.export, ['--binary', '--compress', '--dbname', self.db_name,
+                                                         '--uri', self.url, self.output_dir])
+            self.assertEqual(result.output, "Exported 1 tables to 1 files\n")
+
+            result = self.runner.invoke(pgmerge.upsert, ['--dbname', self.db_name, '--uri', self.url,
+                                                         self.output_dir, table_name])
+            # Since data hasn't changed, the import should change nothing. All lines should be skipped.
+            self.compare_table_output(result.output, [
+                ["country:"],
+                ["skip:", "3", "insert:", "0", "update:", "0"],
+            ], "1 tables imported successfully")
+
+            os.remove(os.path.join(self.output_dir, "{}.bin.gz".format(table_name)))
+
     def test_config_references(self):
         """
         Test import and export that uses config file to select an alternate key.
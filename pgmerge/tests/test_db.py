@@ -10,6 +10,8 @@ from contextlib import contextmanager
 import sqlalchemy
 import psycopg2.extensions as psyext
 
+from pgmerge.pgmerge import dispose_engines
+
 
 @contextmanager
 def create_table(engine, table):
@@ -58,6 +60,9 @@ class TestDB(unittest.TestCase):
 
     @classmethod
     def create_db(cls, db_name):
+        # Close any pooled connections held by the CLI's cached engines so they don't block
+        # dropping/creating the database
+        dispose_engines()
         # Open connection to template database (could build url with sqlalchemy.engine.url.URL)
         cls.create_db_engine = sqlalchemy.create_engine(cls.url + cls.initial_db)
         with cls.create_db_engine.connect() as conn:
@@ -73,6 +78,9 @@ class TestDB(unittest.TestCase):
 
     @classmethod
     def drop_db(cls, db_name):
+        # Close any pooled connections held by the CLI's cached engines so they don't block
+        # dropping the database
+        dispose_engines()
         if cls.engine is not None:
             cls.engine.dispose()
             cls.engine = None
@@ -63,9 +63,20 @@ def only_file_stem(file_path):
     Get name of file without directory path and extension.
     """
     file_name_only = os.path.basename(file_path)
+    # Strip any compression extension first so that e.g. "table.csv.gz" gives "table"
+    if file_name_only.endswith('.gz'):
+        file_name_only = os.path.splitext(file_name_only)[0]
     file_name_only = os.path.splitext(file_name_only)[0]
     return file_name_only
 
 
+def list_files(directory):
+    """
+    Get a sorted list of the names of all files directly in the given directory. Uses os.scandir
+    so that file types come from the single directory read instead of a stat call per entry.
+    """
+    return sorted(entry.name for entry in os.scandir(directory) if entry.is_file())
+
+
 def is_windows():
     return os.name == 'nt'